@@ -1,11 +1,32 @@
 # https://github.com/fgregg/cocktails/blob/645809cf8f67066713436255b418914e98d85a48/cocktails.py
 # copyright Forest Gregg 2023
-import ipdb
-from typing import AbstractSet, Set, FrozenSet, Optional
+from bisect import bisect_left
+from itertools import accumulate
+from typing import AbstractSet, FrozenSet, Tuple
 
 Cocktail = FrozenSet[str]
 Cocktails = AbstractSet[Cocktail]
-Ingredients = Set[str]
+
+# while searching, a cocktail is an integer bitmask of its ingredients,
+# so unions, subset tests and sizes are single integer operations.
+# int.bit_count is already a C-level popcount over the int's internal
+# digits, so sizes need no lookup tables or extension code
+CocktailMask = int
+IngredientMask = int
+
+# collections of cocktails are kept as dense lists of masks rather
+# than sets, so that every filter over them is a single pass over
+# contiguous ints. a cocktail never appears twice in one, so we don't
+# need sets to deduplicate them, and we never hash them. a node's
+# lists are built once, as its parent is expanded, and never changed
+# after, so children can be handed them without a copy
+CocktailMasks = list[CocktailMask]
+Candidates = CocktailMasks
+
+# a node of the search: its candidates, the cocktails we can already
+# make, the cocktails we've ruled out, the ingredients so far, and the
+# ingredients of all the candidates
+Node = Tuple[Candidates, CocktailMasks, CocktailMasks, IngredientMask, IngredientMask]
 
 
 class BranchBound(object):
@@ -15,134 +36,258 @@ class BranchBound(object):
 
         self.highest_score: int = 0
         self.highest: Cocktails = set()
+        self.highest_masks: CocktailMasks = []
 
-        self.min_amortized_cost: dict[Cocktail, float] = {}
-        self.min_cover: dict[Cocktail, int] = {}
+        self.ingredient_id: dict[str, int] = {}
+        self.cocktail_of: dict[CocktailMask, Cocktail] = {}
+        self.min_amortized_cost: dict[CocktailMask, float] = {}
+        self.unique_ingredients: IngredientMask = 0
         self.rounds: int = 0
 
-    def search(
-        self,
-        candidates: Cocktails,
-        partial: Optional[Cocktails] = None,
-        forbidden: Optional[Cocktails] = None,
-    ) -> Cocktails:
-        if partial is None or forbidden is None:
-            # We'll only hit this condition on the first call, so
-            # we set up our cocktail scoring dictionary
-            partial = set()
-            forbidden = set()
-            cardinality: dict[str, int] = {}
-            for cocktail in candidates:
-                for ingredient in cocktail:
-                    if ingredient in cardinality:
-                        cardinality[ingredient] += 1
-                    else:
-                        cardinality[ingredient] = 1
-
-            # For each cocktail, we can calculate the minimum
-            # amoritized cost. That is, if we were to have enough
-            # ingredients to make all the cocktails, how much should
-            # we pay, in ingredient-cost, for each cocktail. For
-            # example, if a cocktail has a unique ingredient, and two
-            # other ingredients shared by one other cocktail, then the
-            # amortized cost would be 1/1 + 1/2 + 1/2 = 2
-            #
-            # The minimum amoritized cost is a lower bound to how much
-            # we will ever pay in ingredient cost for a cocktail.
-            for cocktail in candidates:
-                self.min_amortized_cost[cocktail] = sum(
-                    1.0 / cardinality[ingredient] for ingredient in cocktail
-                )
-                self.min_cover[cocktail] = min(
-                    cardinality[ingredient] for ingredient in cocktail
-                )
+    def search(self, candidates: Cocktails) -> Cocktails:
+        # set up our cocktail scoring dictionary
+        cardinality: dict[str, int] = {}
+        for cocktail in candidates:
+            for ingredient in cocktail:
+                if ingredient in cardinality:
+                    cardinality[ingredient] += 1
+                else:
+                    cardinality[ingredient] = 1
+
+        # For each cocktail, we can calculate the minimum
+        # amoritized cost. That is, if we were to have enough
+        # ingredients to make all the cocktails, how much should
+        # we pay, in ingredient-cost, for each cocktail. For
+        # example, if a cocktail has a unique ingredient, and two
+        # other ingredients shared by one other cocktail, then the
+        # amortized cost would be 1/1 + 1/2 + 1/2 = 2
+        #
+        # The minimum amoritized cost is a lower bound to how much
+        # we will ever pay in ingredient cost for a cocktail.
+        #
+        # Internally, every ingredient is interned to a bit and
+        # every cocktail becomes a bitmask of its ingredients
+        masks = []
+        for cocktail in candidates:
+            mask = 0
+            for ingredient in cocktail:
+                bit = self.ingredient_id.setdefault(ingredient, len(self.ingredient_id))
+                mask |= 1 << bit
+            masks.append(mask)
+            self.cocktail_of[mask] = cocktail
+
+            self.min_amortized_cost[mask] = sum(
+                1.0 / cardinality[ingredient] for ingredient in cocktail
+            )
+
+        # a cocktail's minimum cover is 1 exactly when it has an
+        # ingredient no other cocktail uses, so we only need to
+        # remember which ingredients those are
+        for ingredient, count in cardinality.items():
+            if count == 1:
+                self.unique_ingredients |= 1 << self.ingredient_id[ingredient]
+
+        # a cocktail with more ingredients than our budget can never
+        # be made. the root's candidates are never checked against the
+        # budget, so unless we drop these here, one could be picked as
+        # best and returned as part of an impossible answer
+        masks = [mask for mask in masks if mask.bit_count() <= self.max_size]
+
+        # the candidates are kept in order of their minimum amortized
+        # cost. every filter keeps that order, so the cheapest
+        # candidate at any node is simply the first
+        masks.sort(key=self.min_amortized_cost.__getitem__)
+
+        all_ingredients = 0
+        for mask in masks:
+            all_ingredients |= mask
+        stack: list[Node] = [(masks, [], [], 0, all_ingredients)]
+        self.explore(stack)
+
+        # decode back to ingredient names only once we're done
+        self.highest = {self.cocktail_of[mask] for mask in self.highest_masks}
+        return self.highest
 
-        if self.calls <= 0:
-            print("early stop")
-            return self.highest
-
-        self.calls -= 1
-        self.rounds += 1
-        score = len(partial)
-
-        if score > self.highest_score:
-
-            self.highest = partial
-            self.highest_score = score
-            # print(sorted(cocktails[k] for k in self.highest))
-            # print(self.highest_score)
-
-        partial_ingredients = set().union(*partial)
-        keep_exploring = self.keep_exploring(candidates, partial, partial_ingredients)
-        if candidates and keep_exploring:
-            # the best heuristic i've found is to pick the candidates
-            # with the smallest, minimum amortized cost
-            best = min(candidates, key=lambda x: self.min_amortized_cost[x])
-
-            new_partial_ingredients = partial_ingredients | best
-            covered_candidates = {
-                cocktail
-                for cocktail in candidates
-                if cocktail <= new_partial_ingredients
-            }
-            permitted_candidates = set()
-            for cocktail in candidates - covered_candidates:
-                extended_ingredients = cocktail | new_partial_ingredients
-                if len(extended_ingredients) <= self.max_size:
-
-                    # when we branch, we need to not only remove
-                    # a cocktail from the candidate set, but make
-                    # it impossible that final ingredient list could
-                    # be a superset of the cocktail. failing this, we
-                    # could undercount the score of branch.
-                    #
-                    # unfortunately, this is an O(N^2) operation.
-                    forbidden_cover = any(
-                        forbidden_cocktail <= extended_ingredients
-                        for forbidden_cocktail in forbidden
-                    )
-                    if not forbidden_cover:
-                        permitted_candidates.add(cocktail)
+    def explore(self, stack: list[Node]) -> None:
+        """
+        depth first branch and bound over the nodes on stack.
 
-            self.search(permitted_candidates, partial | covered_candidates, forbidden)
+        rather than recursing, the nodes still to visit are kept on
+        an explicit last in, first out stack, so deep searches aren't
+        bounded by the interpreter's recursion limit and pay no frame
+        setup per node
+        """
 
-            remaining = {
-                cocktail
-                for cocktail in candidates - set([best])
-                if not (best <= (cocktail | partial_ingredients))
-            }
+        # the budget and round count are kept in locals while we
+        # search, and written back once when we stop
+        max_rounds = self.calls
+        rounds = 0
 
-            forbidden = forbidden | set([best])
+        # the same goes for everything fixed for the whole search,
+        # so the loop below reads them without an attribute lookup
+        max_size = self.max_size
+        keep_exploring = self.keep_exploring
 
-            self.search(remaining, partial, forbidden)
+        while stack:
+            if rounds >= max_rounds:
+                print("early stop")
+                break
+            (
+                candidates,
+                partial,
+                forbidden,
+                partial_ingredients,
+                candidate_ingredients,
+            ) = stack.pop()
+            rounds += 1
+            score = len(partial)
+
+            if score > self.highest_score:
+
+                self.highest_masks = partial
+                self.highest_score = score
+                # print(sorted(cocktails[k] for k in self.highest))
+                # print(self.highest_score)
+
+            if candidates and keep_exploring(
+                candidates, partial, partial_ingredients, candidate_ingredients
+            ):
+                # the best heuristic i've found is to pick the candidates
+                # with the smallest, minimum amortized cost
+                best = candidates[0]
+
+                new_partial_ingredients = partial_ingredients | best
+                budget = max_size - new_partial_ingredients.bit_count()
+
+                # when we branch, we need to not only remove
+                # a cocktail from the candidate set, but make
+                # it impossible that final ingredient list could
+                # be a superset of the cocktail. failing this, we
+                # could undercount the score of branch.
+                #
+                # checking every candidate against every forbidden
+                # cocktail is O(N^2), so first we reduce each forbidden
+                # cocktail to the ingredients it still needs. one that
+                # needs more than the budget, or anything no candidate
+                # has, can't be completed by any candidate, and is
+                # never checked.
+                forbidden_needs = [
+                    needs
+                    for needs in (
+                        forbidden_cocktail & ~new_partial_ingredients
+                        for forbidden_cocktail in forbidden
+                    )
+                    if needs.bit_count() <= budget
+                    and not needs & ~candidate_ingredients
+                ]
+
+                # a single pass over the candidates sorts each of them
+                # into the children. the union of each child's
+                # candidates is built up as we go, rather than
+                # recomputed by the bounds
+                covered_candidates = []
+                permitted_candidates = []
+                permitted_ingredients = 0
+                remaining = []
+                remaining_ingredients = 0
+                for cocktail in candidates:
+                    # a cocktail is left out of the branch without best
+                    # when best is a subset of it, which also drops best
+                    # itself
+                    if best & ~(cocktail | partial_ingredients):
+                        remaining.append(cocktail)
+                        remaining_ingredients |= cocktail
+
+                    extended_ingredients = cocktail | new_partial_ingredients
+                    if extended_ingredients == new_partial_ingredients:
+                        covered_candidates.append(cocktail)
+                    elif extended_ingredients.bit_count() <= max_size:
+                        forbidden_cover = forbidden_needs and any(
+                            not needs & ~cocktail for needs in forbidden_needs
+                        )
+                        if not forbidden_cover:
+                            permitted_candidates.append(cocktail)
+                            permitted_ingredients |= cocktail
+
+                # the two branches split the search space in two: every
+                # ingredient list below the first contains best, and none
+                # below the second does. so a (candidates, ingredients,
+                # forbidden) state is never visited twice, and there is
+                # nothing for a memo of subproblems, or a cache of their
+                # bounds, to reuse.
+                stack.append(
+                    (
+                        remaining,
+                        partial,
+                        forbidden + [best],
+                        partial_ingredients,
+                        remaining_ingredients,
+                    )
+                )
 
-        return self.highest
+                # the last node pushed is the first explored, so we look
+                # at the branch that takes best first
+                stack.append(
+                    (
+                        permitted_candidates,
+                        # the covered candidates are never already in
+                        # partial, as partial's cocktails have all left
+                        # the candidates
+                        partial + covered_candidates,
+                        forbidden,
+                        # best is among the covered candidates, and every other
+                        # covered candidate is a subset of the new ingredients
+                        new_partial_ingredients,
+                        permitted_ingredients,
+                    )
+                )
+
+        self.calls = max_rounds - rounds
+        self.rounds += rounds
 
     def keep_exploring(
         self,
-        candidates: Cocktails,
-        partial: Cocktails,
-        partial_ingredients: Ingredients,
+        candidates: Candidates,
+        partial: CocktailMasks,
+        partial_ingredients: IngredientMask,
+        candidate_ingredients: IngredientMask,
     ) -> bool:
         threshold = self.highest_score - len(partial)
 
-        bound_functions = (
-            self.total_bound,
-            self.singleton_bound,
-            self.concentration_bound,
-        )
-        for func in bound_functions:
-            bound = func(candidates, partial, partial_ingredients)
-            if bound <= threshold:
-                return False
+        # the bounds are checked cheapest first, and everything the
+        # other two need from the candidates is gathered in one pass
+        if self.total_bound(candidates) <= threshold:
+            return False
+
+        unique_ingredients = self.unique_ingredients
+        n_unique_cocktails = 0
+        ingredient_increases = []
+        for cocktail in candidates:
+            if cocktail & unique_ingredients:
+                n_unique_cocktails += 1
+            ingredient_increases.append((cocktail & ~partial_ingredients).bit_count())
+
+        if (
+            self.singleton_bound(candidates, n_unique_cocktails, partial_ingredients)
+            <= threshold
+        ):
+            return False
+
+        if (
+            self.concentration_bound(
+                ingredient_increases, partial_ingredients, candidate_ingredients
+            )
+            <= threshold
+        ):
+            return False
 
         return True
 
     def concentration_bound(
         self,
-        candidates: Cocktails,
-        partial: Cocktails,
-        partial_ingredients: Ingredients,
+        ingredient_increases: list[int],
+        partial_ingredients: IngredientMask,
+        candidate_ingredients: IngredientMask,
     ) -> int:
         """
         best case is that excess ingredients are concentrated in
@@ -155,39 +300,32 @@ class BranchBound(object):
         a lot of ingredients
         """
 
-        candidate_ingredients: Ingredients
-        candidate_ingredients = set().union(*candidates)
         excess_ingredients = (
-            len(candidate_ingredients | partial_ingredients) - self.max_size
-        )
+            candidate_ingredients | partial_ingredients
+        ).bit_count() - self.max_size
+
+        if excess_ingredients <= 0:
+            return len(ingredient_increases)
 
-        ingredient_increases = sorted(
-            (len(cocktail - partial_ingredients) for cocktail in candidates),
-            reverse=True,
+        # the number of cocktails we have to drop is the shortest
+        # prefix of the largest increases that covers the excess
+        ingredient_increases = sorted(ingredient_increases, reverse=True)
+        n_dropped = (
+            bisect_left(list(accumulate(ingredient_increases)), excess_ingredients) + 1
         )
 
-        upper_increment = len(candidates)
-        for ingredient_increase in ingredient_increases:
-            if excess_ingredients <= 0:
-                break
-            upper_increment -= 1
-            excess_ingredients -= ingredient_increase
+        upper_increment = max(len(ingredient_increases) - n_dropped, 0)
 
         return upper_increment
 
-    def total_bound(
-        self,
-        candidates: Cocktails,
-        partial: Cocktails,
-        partial_ingredients: Ingredients,
-    ) -> int:
+    def total_bound(self, candidates: Candidates) -> int:
         return len(candidates)
 
     def singleton_bound(
         self,
-        candidates: Cocktails,
-        partial: Cocktails,
-        partial_ingredients: Ingredients,
+        candidates: Candidates,
+        n_unique_cocktails: int,
+        partial_ingredients: IngredientMask,
     ) -> int:
         """
         There are many cocktails that have an unique ingredient.
@@ -198,10 +336,7 @@ class BranchBound(object):
         by the ingredient budget
         """
 
-        n_unique_cocktails = sum(
-            1 for cocktail in candidates if self.min_cover[cocktail] == 1
-        )
-        ingredient_budget = self.max_size - len(partial_ingredients)
+        ingredient_budget = self.max_size - partial_ingredients.bit_count()
 
         upper_increment = (
             len(candidates)